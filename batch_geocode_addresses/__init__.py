@@ -1,12 +1,25 @@
 import logging
 import os
-import json
+import io
+import orjson
+import asyncio
 from azure.storage.blob import BlobServiceClient
 from azure.core.credentials import AzureKeyCredential
-from azure.maps.search import MapsSearchClient
+from azure.maps.search.aio import MapsSearchClient
 from azure.core.exceptions import HttpResponseError
 
-def main(myblob):
+# Azure Maps accepts up to 100 queries per geocoding batch and a handful of
+# concurrent batch requests; keep in-flight requests bounded accordingly
+BATCH_SIZE = 100
+MAX_CONCURRENT_BATCHES = 4
+
+# Required settings resolved once at import so a missing value fails the
+# function load instead of every invocation; the blob client is built once
+# and reused while the worker stays warm
+_MAPS_CREDENTIAL = AzureKeyCredential(os.environ["AZURE_MAPS_KEY"])
+_blob_service_client = BlobServiceClient.from_connection_string(os.environ["batchprocessblob_STORAGE"])
+
+async def main(myblob):
     """
     Azure Function Blob Trigger to geocode addresses from processed batch results and save updated data.
     """
@@ -15,99 +28,135 @@ def main(myblob):
         blob_name = myblob.name
         logging.info(f"Processing geocoding for blob: {blob_name}")
 
-        # Read blob content
-        content = myblob.read().decode("utf-8")
-        data = [json.loads(line) for line in content.strip().split("\n")]
-
-        # Azure Maps setup
-        maps_credential = AzureKeyCredential(os.getenv("AZURE_MAPS_KEY"))
-        maps_client = MapsSearchClient(credential=maps_credential)
+        # Stream blob content line by line instead of materializing the full
+        # decoded string and record list (orjson.loads accepts bytes directly)
+        stream = io.BytesIO(myblob.read())
+        records = (orjson.loads(line) for line in stream if line.strip())
 
-        # Batch geocoding
-        batch_size = 10  # Define your batch size here
-        batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+        # First pass: pull the query string out of every record. Repeated
+        # locations (common in listing data) collapse to one query each.
         results = []
+        # Items awaiting a geocoding result, paired with their already-parsed
+        # message payload and query so the inner JSON is parsed and dumped
+        # exactly once per item
+        pending = []
+        unique_queries = set()
 
-        for batch in batches:
-            batch_request = {"batchItems": []}
-            
-            for item in batch:
-                message_content = item.get("response", {}).get("body", {}).get("choices", [])[0].get("message", {}).get("content", "")
-                if message_content:
-                    message_data = json.loads(message_content)
-                    location = message_data.get("location", "")
-                    if location:
-                        query = location if "india" in location.lower() else f"{location}, India"
-                        logging.debug(f"Appending query: {query}")
-                        batch_request["batchItems"].append({"query": query})
-                    else:
-                        logging.warning(f"No location found for item: {item.get('custom_id')}")
-                        message_data["geolocation"] = "no location available"
-                        item["response"]["body"]["choices"][0]["message"]["content"] = json.dumps(message_data)
-                        results.append(item)
-                else:
-                    logging.warning(f"No message content found for item: {item.get('custom_id')}")
-                    item["response"]["body"]["choices"][0]["message"]["content"] = json.dumps({"geolocation": "no location available"})
-                    results.append(item)
-            
+        for item in records:
+            # The schema is fixed, so index directly instead of chaining .get
+            # calls that allocate a default container per lookup
             try:
-                if batch_request["batchItems"]:
-                    response = maps_client.get_geocoding_batch(batch_request)
-                    
-                    if not response.get('batchItems', False):
-                        logging.warning("No batchItems in geocoding response")
-                        results.extend([None] * len(batch))
-                        continue
-                    
-                    # Process each item in the batch response
-                    for item, original_addr in zip(response['batchItems'], batch):
-                        if not item.get('features', False):
-                            logging.warning(f"No features found for address: {original_addr}")
-                            results.append(None)
-                            continue
-                        
-                        try:
-                            coordinates = item['features'][0]['geometry']['coordinates']
-                            longitude, latitude = coordinates
-                            
-                            geolocation_obj = {
-                                "type": "Point",
-                                "coordinates": [longitude, latitude]
-                            }
-                            message_data = json.loads(original_addr["response"]["body"]["choices"][0]["message"]["content"])
-                            message_data["geolocation"] = geolocation_obj
-                            original_addr["response"]["body"]["choices"][0]["message"]["content"] = json.dumps(message_data)
-                            results.append(original_addr)
-                            
-                            logging.info(f"Successfully geocoded: {original_addr} -> ({latitude}, {longitude})")
-                        except (IndexError, KeyError) as e:
-                            logging.error(f"Error processing geocoding result for {original_addr}: {str(e)}")
-                            results.append(None)
-                            
+                message_content = item["response"]["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                message_content = ""
+            if message_content:
+                message_data = orjson.loads(message_content)
+                location = message_data.get("location", "")
+                if location:
+                    query = location if "india" in location.lower() else f"{location}, India"
+                    logging.debug(f"Appending query: {query}")
+                    unique_queries.add(query)
+                    pending.append((item, message_data, query))
                 else:
-                    logging.warning("Batch request is empty, skipping geocoding for this batch.")
+                    logging.warning(f"No location found for item: {item.get('custom_id')}")
+                    message_data["geolocation"] = "no location available"
+                    item["response"]["body"]["choices"][0]["message"]["content"] = orjson.dumps(message_data).decode()
+                    results.append(item)
+            else:
+                logging.warning(f"No message content found for item: {item.get('custom_id')}")
+                item["response"]["body"]["choices"][0]["message"]["content"] = orjson.dumps({"geolocation": "no location available"}).decode()
+                results.append(item)
+
+        # Second pass: geocode only the unique queries, batched and in
+        # flight concurrently behind a semaphore
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+        query_list = list(unique_queries)
+        geocoded = {}
+        async with MapsSearchClient(credential=_MAPS_CREDENTIAL) as maps_client:
+            tasks = [
+                geocode_queries(maps_client, semaphore, query_list[i:i + BATCH_SIZE])
+                for i in range(0, len(query_list), BATCH_SIZE)
+            ]
+            for batch_result in await asyncio.gather(*tasks):
+                geocoded.update(batch_result)
+
+        # Third pass: map the shared geocoding results back onto every item
+        for item, message_data, query in pending:
+            geolocation_obj = geocoded.get(query)
+            if geolocation_obj is None:
+                logging.warning(f"No features found for address: {item}")
+                results.append(None)
+                continue
+            message_data["geolocation"] = geolocation_obj
+            item["response"]["body"]["choices"][0]["message"]["content"] = orjson.dumps(message_data).decode()
+            results.append(item)
 
-            except HttpResponseError as exception:
-                if exception.error:
-                    logging.error(f"Batch geocoding error - Code: {exception.error.code}, Message: {exception.error.message}")
-                else:
-                    logging.error(f"Batch geocoding error: {str(exception)}")
-                results.extend([None] * len(batch))
-            except Exception as e:
-                logging.error(f"Unexpected error in batch geocoding: {str(e)}")
-                results.extend([None] * len(batch))
-    
         # Save updated results to geocoded-results container
-        connection_string = os.getenv("batchprocessblob_STORAGE")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         output_container = "geocoded-results"
-        output_blob_name = f"{os.path.basename(blob_name).replace('.jsonl', '-geocoded.jsonl')}"
-        blob_client = blob_service_client.get_blob_client(container=output_container, blob=output_blob_name)
+        output_blob_name = f"{os.path.basename(blob_name).removesuffix('.jsonl')}-geocoded.jsonl"
+        blob_client = _blob_service_client.get_blob_client(container=output_container, blob=output_blob_name)
 
         logging.info(f"Saving geocoded results to {output_container}/{output_blob_name}")
-        blob_client.upload_blob("\n".join([json.dumps(result) for result in results if result]), overwrite=True)
+        # Stream serialized lines into a bytes buffer rather than joining one
+        # large bytestring in memory
+        output_buffer = io.BytesIO()
+        for result in results:
+            if result:
+                output_buffer.write(orjson.dumps(result))
+                output_buffer.write(b"\n")
+        output_buffer.seek(0)
+        # The blob client is sync; run the upload in a worker thread so a
+        # multi-MB write does not stall the other async functions sharing
+        # this worker's event loop
+        await asyncio.to_thread(blob_client.upload_blob, output_buffer, overwrite=True)
         logging.info("Geocoding results saved successfully.")
 
     except Exception as e:
         logging.error(f"Error during geocoding for blob '{blob_name}': {str(e)}")
 
+
+async def geocode_queries(maps_client, semaphore, queries):
+    """
+    Geocodes one batch of query strings against Azure Maps and returns a dict
+    mapping each query to its GeoJSON point (or None when nothing was found).
+    """
+    geocoded = {}
+    batch_request = {"batchItems": [{"query": query} for query in queries]}
+
+    try:
+        async with semaphore:
+            response = await maps_client.get_geocoding_batch(batch_request)
+
+        if not response.get('batchItems', False):
+            logging.warning("No batchItems in geocoding response")
+            return geocoded
+
+        # Process each item in the batch response
+        for item, query in zip(response['batchItems'], queries):
+            if not item.get('features', False):
+                logging.warning(f"No features found for query: {query}")
+                geocoded[query] = None
+                continue
+
+            try:
+                coordinates = item['features'][0]['geometry']['coordinates']
+                longitude, latitude = coordinates
+
+                geocoded[query] = {
+                    "type": "Point",
+                    "coordinates": [longitude, latitude]
+                }
+                logging.info(f"Successfully geocoded: {query} -> ({latitude}, {longitude})")
+            except (IndexError, KeyError) as e:
+                logging.error(f"Error processing geocoding result for {query}: {str(e)}")
+                geocoded[query] = None
+
+    except HttpResponseError as exception:
+        if exception.error:
+            logging.error(f"Batch geocoding error - Code: {exception.error.code}, Message: {exception.error.message}")
+        else:
+            logging.error(f"Batch geocoding error: {str(exception)}")
+    except Exception as e:
+        logging.error(f"Unexpected error in batch geocoding: {str(e)}")
+
+    return geocoded
@@ -1,61 +1,21 @@
 import logging
-from azure.storage.blob import BlobServiceClient
-import json
+from azure.storage.blob.aio import BlobServiceClient
+import orjson
+import io
 import os
 import re
 
-def main(myblob):
-    """
-    Azure Function Blob Trigger to transform JSON into JSONL format and save to another container.
-    """
-    blob_name = myblob.name
-    logging.info(f"Processing blob: {blob_name}")
-
-    # Check if the blob has a .json extension
-    if not blob_name.lower().endswith('.json'):
-        logging.warning(f"Skipping blob '{blob_name}' as it is not a .json file.")
-        return
-
-    try:
-        # Retrieve the storage connection string
-        connection_string = os.getenv("batchprocessblob_STORAGE")
-        if not connection_string:
-            logging.error("Missing storage connection string 'batchprocessblob_STORAGE'.")
-            return
-
-        # Initialize BlobServiceClient
-        try:
-            blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-            logging.info("Successfully connected to Azure Blob Storage.")
-        except Exception as e:
-            logging.error(f"Failed to initialize BlobServiceClient: {e}")
-            return
-
-        # Read the blob content
-        try:
-            content = myblob.read().decode("utf-8")
-            if not content.strip():
-                logging.warning(f"Blob '{blob_name}' is empty. Skipping processing.")
-                return
-            logging.info(f"Successfully read content from blob '{blob_name}'.")
-        except Exception as e:
-            logging.error(f"Failed to read blob content '{blob_name}': {e}")
-            return
-
-        # Parse JSON content
-        try:
-            json_data = json.loads(content)
-            logging.info(f"Successfully parsed JSON content from blob '{blob_name}'.")
-        except json.JSONDecodeError as e:
-            logging.error(f"Invalid JSON format in blob '{blob_name}': {e}")
-            return
-        
+# Compiled once at import so the per-item search skips the re cache lookup
+_URL_RE = re.compile(r"https?://\S+")
 
+# Built once at import and reused while the worker stays warm; the Functions
+# host shares one event loop across invocations, so tearing the client (and
+# its connection pool) down per blob would pay the TLS handshake every time
+_blob_service_client = BlobServiceClient.from_connection_string(os.environ["batchprocessblob_STORAGE"])
 
-        # Transform JSON content into JSONL format
-        try:
-            
-            prompt = f"""
+# Static system prompt and response schema shared by every transformed line;
+# built once at import instead of per blob invocation
+_PROMPT = """
             Extract property listing information from this chat message:
             If a field is not available, leave it blank.
             If any of the value is not available that we need to give in the response format then leave it blank.
@@ -69,7 +29,7 @@ def main(myblob):
             area: "Area in square feet"
             location: "Location of the property"
             price "Price of the property in rupees"
-            property_subtype: "Subtype of property based on category:         
+            property_subtype: "Subtype of property based on category:
             Commercial: Office, Shop, Showroom, School, College, Hospital
             Land: Agricultural land, Commercial land, Industrial land, Residential Plot, Commercial Plot
             Industrial: Factory, Warehouse, Godown
@@ -87,10 +47,47 @@ def main(myblob):
             isOwnerListing: Optional[bool] = False
             """
 
-            response_format = {"type": "json_schema", "json_schema": {"name": "property_listing_schema", "schema": {"type": "object", "properties": {"requirement": {"type": "string"}, "description": {"type": "string"}, "area": {"type": "string"}, "location": {"type": "string"}, "price": {"type": "string"},"name": {"type": "string"},"contact_number": {"type": "string"}, "url": {"type": "string"}}, "required": ["requirement", "description", "area", "location", "price", "name", "contact_number", "url"], "additionalProperties": False}, "strict": True}}
+_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "property_listing_schema", "schema": {"type": "object", "properties": {"requirement": {"type": "string"}, "description": {"type": "string"}, "area": {"type": "string"}, "location": {"type": "string"}, "price": {"type": "string"},"name": {"type": "string"},"contact_number": {"type": "string"}, "url": {"type": "string"}}, "required": ["requirement", "description", "area", "location", "price", "name", "contact_number", "url"], "additionalProperties": False}, "strict": True}}
+
+async def main(myblob):
+    """
+    Azure Function Blob Trigger to transform JSON into JSONL format and save to another container.
+    """
+    blob_name = myblob.name
+    logging.info(f"Processing blob: {blob_name}")
+
+    # Check if the blob has a .json extension
+    if not blob_name.lower().endswith('.json'):
+        logging.warning(f"Skipping blob '{blob_name}' as it is not a .json file.")
+        return
+
+    try:
+        # Read the blob content as bytes; orjson parses them directly so the
+        # full-size decoded string is never built
+        try:
+            content = myblob.read()
+            if not content.strip():
+                logging.warning(f"Blob '{blob_name}' is empty. Skipping processing.")
+                return
+            logging.info(f"Successfully read content from blob '{blob_name}'.")
+        except Exception as e:
+            logging.error(f"Failed to read blob content '{blob_name}': {e}")
+            return
+
+        # Parse JSON content
+        try:
+            json_data = orjson.loads(content)
+            logging.info(f"Successfully parsed JSON content from blob '{blob_name}'.")
+        except orjson.JSONDecodeError as e:
+            logging.error(f"Invalid JSON format in blob '{blob_name}': {e}")
+            return
+        
+
 
-            transformed_lines = []
-            url_pattern = r"https?://[^\s]+"
+        # Transform JSON content into JSONL format, writing serialized lines
+        # straight into a bytes buffer instead of a list joined afterwards
+        try:
+            jsonl_buffer = io.BytesIO()
 
             for i, item in enumerate(json_data):
                 message = item.get("message", "")
@@ -98,7 +95,7 @@ def main(myblob):
                 phone = item.get("phone", "")
                 
                 # Extract URL if present
-                url_match = re.search(url_pattern, message)
+                url_match = _URL_RE.search(message)
                 url = url_match.group(0) if url_match else ""
                 
                 # Combine fields into user content
@@ -111,29 +108,31 @@ def main(myblob):
                     "body": {
                         "model": "gpt-4o",
                         "messages": [
-                            {"role": "system", "content": prompt},
+                            {"role": "system", "content": _PROMPT},
                             {"role": "user", "content": user_content}
                         ],
-                        "response_format": response_format
+                        "response_format": _RESPONSE_FORMAT
                     }
                 }
-                transformed_lines.append(json.dumps(transformed_item))
-            jsonl_content = "\n".join(transformed_lines)
+                jsonl_buffer.write(orjson.dumps(transformed_item))
+                jsonl_buffer.write(b"\n")
+            jsonl_buffer.seek(0)
             logging.info("Successfully transformed JSON content to JSONL format.")
         except Exception as e:
             logging.error(f"Failed to transform JSON content: {e}")
             return
 
-        # Write the transformed content to the target container
+        # Write the transformed content to the target container through the
+        # async client so the upload shares the worker's event loop instead
+        # of blocking it
         try:
             target_container_name = "jsonl-chatfiles"
             filename = os.path.basename(blob_name)
-            target_blob_name = filename.replace(".json", ".jsonl")
-            target_blob_client = blob_service_client.get_blob_client(
+            target_blob_name = f"{filename.removesuffix('.json')}.jsonl"
+            target_blob_client = _blob_service_client.get_blob_client(
                 container=target_container_name, blob=target_blob_name
             )
-
-            target_blob_client.upload_blob(jsonl_content, overwrite=True)
+            await target_blob_client.upload_blob(jsonl_buffer, overwrite=True)
             logging.info(f"Successfully uploaded JSONL file to: {target_container_name}/{target_blob_name}")
         except Exception as e:
             logging.error(f"Failed to upload transformed JSONL blob '{blob_name}': {e}")
@@ -0,0 +1,155 @@
+import logging
+import os
+import io
+from datetime import datetime
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError, ServiceRequestError
+from azure.storage.blob import BlobServiceClient
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+from openai import AzureOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+import openai
+import orjson
+
+# Hourly aggregates written by uploadToOpenAi for small blobs; each closed
+# aggregate becomes one OpenAI file and one batch job
+PENDING_CONTAINER = "pending-batches"
+POLL_QUEUE_NAME = "openai-file-poll"
+
+# Retry only transient failures (rate limits, dropped connections, 5xx);
+# anything else surfaces immediately
+_transient_retry = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+        ServiceRequestError,
+    )),
+    reraise=True,
+)
+
+# Clients initialized on first invocation and reused while the worker stays
+# warm, so TLS handshakes and connection pools are paid once per instance
+_clients = {}
+
+
+def _get_clients():
+    if not _clients:
+        # max_retries=0: the SDK's built-in retry would re-read the exhausted
+        # upload stream; _transient_retry rebuilds it per attempt instead
+        _clients["oai"] = AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version="2024-10-21",
+            max_retries=0
+        )
+        _clients["blob"] = BlobServiceClient.from_connection_string(
+            os.getenv("batchprocessblob_STORAGE")
+        )
+        _clients["queue"] = QueueClient.from_connection_string(
+            os.getenv("batchprocessblob_STORAGE"), POLL_QUEUE_NAME,
+            message_encode_policy=TextBase64EncodePolicy()
+        )
+    return _clients
+
+
+def main(timer):
+    """
+    Timer Trigger to submit coalesced small-blob aggregates to Azure OpenAI as single batch jobs.
+    """
+    try:
+        clients = _get_clients()
+        blob_service_client = clients["blob"]
+        container_client = blob_service_client.get_container_client(PENDING_CONTAINER)
+
+        # The current hour's aggregate may still be receiving appends; only
+        # flush aggregates from earlier hours
+        current_aggregate = f"{datetime.utcnow():%Y%m%d%H}.jsonl"
+
+        try:
+            pending_blobs = list(container_client.list_blobs())
+        except ResourceNotFoundError:
+            logging.info("No pending-batches container yet; nothing to flush.")
+            return
+
+        # Contain failures per aggregate: a bad aggregate is logged and
+        # retried next tick (its lease simply expires) instead of aborting
+        # the flush of everything behind it
+        for blob in pending_blobs:
+            if blob.name == current_aggregate:
+                continue
+            try:
+                _flush_aggregate(clients, container_client, blob.name)
+            except Exception as e:
+                logging.error(f"Failed to flush aggregate '{blob.name}': {str(e)}")
+
+    except Exception as e:
+        logging.error(f"An error occurred while flushing pending batches: {str(e)}")
+
+
+def _flush_aggregate(clients, container_client, blob_name):
+    """
+    Submits one closed aggregate: uploads it as an OpenAI file, enqueues the
+    status-check message for pollOpenAiFile, and deletes the aggregate.
+    """
+    blob_client = container_client.get_blob_client(blob_name)
+
+    # Lease the aggregate before reading so a straggler append from
+    # uploadToOpenAi cannot land between the download and the delete
+    # and be destroyed; a blocked append fails and the blob event is
+    # retried by the host instead
+    try:
+        lease = blob_client.acquire_lease(lease_duration=60)
+    except (ResourceNotFoundError, HttpResponseError) as e:
+        logging.warning(f"Could not lease aggregate '{blob_name}'; skipping until next tick: {e}")
+        return
+
+    content = blob_client.download_blob(lease=lease).readall()
+    if not content.strip():
+        blob_client.delete_blob(lease=lease)
+        return
+
+    # Upload the aggregate as one OpenAI file
+    logging.info(f"Uploading aggregate '{blob_name}' to Azure OpenAI...")
+    file_response = _upload_aggregate(clients["oai"], blob_name, content)
+    file_id = file_response.id
+    logging.info(f"Aggregate uploaded successfully. File ID: {file_id}")
+
+    # Hand the status polling and batch submission to pollOpenAiFile
+    _enqueue_poll_message(clients["queue"], file_id, blob_name)
+
+    blob_client.delete_blob(lease=lease)
+    logging.info(f"Aggregate '{blob_name}' submitted and removed from {PENDING_CONTAINER}.")
+
+
+@_transient_retry
+def _upload_aggregate(client, blob_name, content):
+    """
+    Uploads the aggregate content to Azure OpenAI, rebuilding the stream on
+    each retry attempt.
+    """
+    jsonl_file = io.BytesIO(content)
+    jsonl_file.name = blob_name
+    return client.files.create(
+        file=jsonl_file,
+        purpose="batch"
+    )
+
+
+@_transient_retry
+def _enqueue_poll_message(queue_client, file_id, filename):
+    """
+    Sends the status-check message that drives pollOpenAiFile, creating the
+    queue on first use.
+    """
+    try:
+        queue_client.create_queue()
+    except ResourceExistsError:
+        pass
+    poll_message = orjson.dumps({
+        "file_id": file_id,
+        "filename": filename,
+        "attempts": 0
+    }).decode()
+    queue_client.send_message(poll_message, visibility_timeout=5)
@@ -0,0 +1,163 @@
+import logging
+import os
+from azure.core.exceptions import ResourceExistsError, ServiceRequestError
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+from openai import AzureOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+import openai
+import orjson
+
+# Re-enqueue backoff doubles per attempt up to five minutes; give up after
+# enough attempts to cover roughly an hour of waiting
+POLL_QUEUE_NAME = "openai-file-poll"
+MAX_ATTEMPTS = 20
+MAX_VISIBILITY_TIMEOUT = 300
+
+# Retry only transient failures (rate limits, dropped connections, 5xx);
+# anything else surfaces immediately
+_transient_retry = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+        ServiceRequestError,
+    )),
+    reraise=True,
+)
+
+# Clients initialized on first invocation and reused while the worker stays
+# warm; queue deliveries arrive in bursts, so rebuilding clients per message
+# would pay the TLS handshake and auth setup on every delivery
+_clients = {}
+
+
+def _get_clients():
+    if not _clients:
+        _clients["oai"] = AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version="2024-10-21"
+        )
+        _clients["blob"] = BlobServiceClient.from_connection_string(
+            os.getenv("batchprocessblob_STORAGE")
+        )
+        _clients["queue"] = QueueClient.from_connection_string(
+            os.getenv("batchprocessblob_STORAGE"), POLL_QUEUE_NAME,
+            message_encode_policy=TextBase64EncodePolicy()
+        )
+    return _clients
+
+
+def main(msg):
+    """
+    Queue Trigger to check an Azure OpenAI file's status, submitting the batch job
+    once the file is processed and re-enqueuing itself while it is still pending.
+    """
+    try:
+        message = orjson.loads(msg.get_body())
+        file_id = message["file_id"]
+        filename = message["filename"]
+        attempts = message.get("attempts", 0)
+        logging.info(f"Checking status of file {file_id} (attempt {attempts + 1})...")
+
+        clients = _get_clients()
+        client = clients["oai"]
+
+        file_info = _retrieve_file(client, file_id)
+        file_status = file_info.status
+        logging.info(f"Current file status: {file_status}")
+
+        if file_status == "failed":
+            logging.error(f"File {file_id} processing failed. Exiting.")
+            return
+
+        if file_status != "processed":
+            # Still pending: re-enqueue with exponential backoff so the next
+            # check happens later without holding a worker in the meantime
+            if attempts >= MAX_ATTEMPTS:
+                logging.error(f"Giving up on file {file_id} after {attempts} status checks.")
+                return
+            queue_client = clients["queue"]
+            message["attempts"] = attempts + 1
+            queue_client.send_message(
+                orjson.dumps(message).decode(),
+                visibility_timeout=min(2 ** attempts, MAX_VISIBILITY_TIMEOUT)
+            )
+            logging.info(f"File {file_id} still {file_status}; re-enqueued status check.")
+            return
+
+        # Queue messages are delivered at least once and the metadata stamp
+        # re-fires the blob trigger, so two polling chains can reach this
+        # point concurrently. Claim the submission by creating the response
+        # blob atomically (overwrite=False) before creating the batch; the
+        # losing chain sees ResourceExistsError instead of double-submitting.
+        container_name = "uploadtoopenai-response"
+        response_blob_name = f"{filename.removesuffix('.jsonl')}-response.json"
+        response_blob_client = clients["blob"].get_blob_client(container=container_name, blob=response_blob_name)
+        claim = orjson.dumps({"status": "submitting", "input_file_id": file_id})
+        try:
+            response_blob_client.upload_blob(claim, overwrite=False)
+        except ResourceExistsError:
+            logging.info(f"Batch for file {file_id} already claimed or submitted; skipping re-delivery.")
+            return
+
+        # File is processed: submit the batch job
+        logging.info("Submitting the batch job to Azure OpenAI...")
+        try:
+            batch_response = _create_batch(client, file_id)
+        except Exception:
+            # Release the claim so a retry of this message can submit
+            try:
+                response_blob_client.delete_blob()
+            except Exception as delete_error:
+                logging.error(f"Failed to release submit claim for file {file_id}: {str(delete_error)}")
+            raise
+        batch_id = batch_response.id
+        logging.info(f"Batch job submitted successfully. Batch ID: {batch_id}")
+
+        # Save full batch response to uploadtoopenai-response container
+        logging.info("Saving batch response to uploadtoopenai-response container...")
+
+        # model_dump_json serializes straight from the pydantic model in
+        # pydantic-core, skipping the intermediate dict tree; upload bytes so
+        # the SDK does not re-encode the string
+        response_json = batch_response.model_dump_json(indent=4)
+        _upload_response(response_blob_client, response_json.encode("utf-8"))
+        logging.info(f"Batch response saved successfully: {container_name}/{response_blob_name}")
+
+    except Exception as e:
+        # Re-raise so the queue retry and poison-queue handling engage
+        # instead of silently dropping the message
+        logging.error(f"An error occurred while polling OpenAI file status: {str(e)}")
+        raise
+
+
+@_transient_retry
+def _retrieve_file(client, file_id):
+    return client.files.retrieve(file_id)
+
+
+@_transient_retry
+def _create_batch(client, file_id):
+    return client.batches.create(
+        input_file_id=file_id,
+        endpoint="/chat/completions",
+        completion_window="24h",
+    )
+
+
+@_transient_retry
+def _upload_response(response_blob_client, data):
+    # Passing length lets the SDK skip its size probe, and max_concurrency
+    # enables parallel block staging if the response outgrows the
+    # single-PUT threshold
+    response_blob_client.upload_blob(
+        data,
+        overwrite=True,
+        length=len(data),
+        max_concurrency=4,
+        content_settings=ContentSettings(content_type="application/json"),
+    )
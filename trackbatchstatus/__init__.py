@@ -1,45 +1,66 @@
 import logging
 import os
-import json
+import orjson
 import time
-import datetime
+from concurrent.futures import ThreadPoolExecutor
 from azure.storage.blob import BlobServiceClient
 from openai import AzureOpenAI
 
+# Same-account server-side copies normally finish immediately; if one is
+# still pending after this many one-second polls, abort it and move on
+COPY_POLL_ATTEMPTS = 30
+
+# Clients initialized on first invocation and reused while the worker stays
+# warm, so connections and auth are not re-established on every timer tick
+_clients = {}
+
+
+def _get_clients():
+    if not _clients:
+        _clients["oai"] = AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version="2024-10-21"
+        )
+        _clients["blob"] = BlobServiceClient.from_connection_string(
+            os.getenv("batchprocessblob_STORAGE")
+        )
+    return _clients
+
 
 def main(timer):
     """
     Timer Trigger to track batch job progress and save results to batchjob-results container.
     """
     try:
-        # Initialize OpenAI client
-        client = AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version="2024-10-21"
-        )
+        clients = _get_clients()
+        client = clients["oai"]
+        blob_service_client = clients["blob"]
 
         # Access Azure Blob Storage containers
         response_container = "uploadtoopenai-response"
         result_container = "batchjob-results"
         finalized_container = "finalized-batches"
-        connection_string = os.getenv("batchprocessblob_STORAGE")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         response_container_client = blob_service_client.get_container_client(response_container)
         result_container_client = blob_service_client.get_container_client(result_container)
         finalized_container_client = blob_service_client.get_container_client(finalized_container)
 
-        # Iterate over all batch response files
-        for blob in response_container_client.list_blobs():
-            blob_client = response_container_client.get_blob_client(blob.name)
-            response_content = blob_client.download_blob().readall()
-            response_data = json.loads(response_content)
+        # Process each batch response file; exceptions are handled inside the
+        # worker so one bad blob cannot take down the whole pool
+        def process_blob(blob):
+            try:
+                blob_client = response_container_client.get_blob_client(blob.name)
+                response_content = blob_client.download_blob(max_concurrency=8).readall()
+                response_data = orjson.loads(response_content)
+            except Exception as e:
+                logging.error(f"Error reading response blob {blob.name}: {str(e)}")
+                return
 
             # Extract batch_id
             batch_id = response_data.get("id")
             if not batch_id:
                 logging.warning(f"No valid batch ID found in blob: {blob.name}")
-                continue
+                return
 
             # Fetch the latest status from Azure OpenAI
             try:
@@ -51,9 +72,12 @@ def main(timer):
                 logging.info(f"Batch Details: {batch_response.model_dump_json(indent=2)}")
                 logging.info(f"Batch ID: {batch_id}, Updated Status: {status}")
 
-                # Update the response file with the latest status
-                response_data["status"] = status
-                blob_client.upload_blob(json.dumps(response_data, indent=4), overwrite=True)
+                # Update the response file only when the status actually
+                # changed, saving one blob write per batch per tick otherwise
+                if response_data.get("status") != status:
+                    response_data["status"] = status
+                    # Compact output — this blob is only ever read back by code
+                    blob_client.upload_blob(orjson.dumps(response_data), overwrite=True)
 
                 # Save the batch output or error files if finalized
                 if status == "completed":
@@ -75,6 +99,15 @@ def main(timer):
             except Exception as e:
                 logging.error(f"Error fetching status for Batch ID {batch_id}: {str(e)}")
 
+        # The per-blob work is network-bound (download, OpenAI retrieve,
+        # upload), so fan out across a thread pool; both SDK clients are
+        # safe to share between threads. Dispatching one listing page at a
+        # time caps in-flight blobs and memory on large containers.
+        pager = response_container_client.list_blobs(results_per_page=100).by_page()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for page in pager:
+                list(executor.map(process_blob, page))
+
     except Exception as e:
         logging.error(f"An error occurred while tracking batch jobs: {str(e)}")
 
@@ -83,7 +116,7 @@ def main(timer):
 def save_batch_file(client, file_id, container_client, batch_id, file_type):
     """
     Helper function to save batch output or error files to batchjob-results container.
-    Saves both .jsonl and .json versions.
+    Saves the raw .jsonl content as returned by Azure OpenAI.
     """
     try:
         if not file_id:
@@ -93,14 +126,16 @@ def save_batch_file(client, file_id, container_client, batch_id, file_type):
         # Retrieve the file content
         logging.info(f"Retrieving {file_type} file for Batch ID: {batch_id}...")
         file_response = client.files.content(file_id)
-        raw_responses = file_response.text.strip()
+        raw_responses = file_response.content.strip()
 
         # Save the .jsonl file
         jsonl_blob_name = f"{batch_id}-{file_type}.jsonl"
         jsonl_blob_client = container_client.get_blob_client(blob=jsonl_blob_name)
 
         logging.info(f"Saving {file_type} .jsonl responses to {jsonl_blob_name}...")
-        jsonl_blob_client.upload_blob(raw_responses, overwrite=True)
+        # Batch output files can run to tens of MB; parallel block staging
+        # keeps the upload from serializing on one connection
+        jsonl_blob_client.upload_blob(raw_responses, overwrite=True, max_concurrency=8)
         logging.info(f".jsonl file saved successfully for Batch ID: {batch_id}")
 
     except Exception as e:
@@ -110,19 +145,18 @@ def save_batch_file(client, file_id, container_client, batch_id, file_type):
 def convert_to_json(jsonl_content):
     """
     Converts JSONL content to a JSON array.
-    
+
     Args:
-        jsonl_content (str): The content of a JSONL file as a string.
-    
+        jsonl_content (bytes): The content of a JSONL file as bytes.
+
     Returns:
-        str: The content as a JSON array (pretty-printed JSON string).
+        bytes: The content as a JSON array.
     """
     try:
-        # Split the content into lines and parse each as a JSON object
-        json_objects = [json.loads(line) for line in jsonl_content.strip().split("\n")]
-        # Convert the list of JSON objects to a JSON array
-        json_array = json.dumps(json_objects, indent=4)
-        return json_array
+        # Each JSONL line is already valid JSON, so joining the lines with
+        # commas builds the array without parsing or re-serializing anything
+        lines = [line for line in jsonl_content.split(b"\n") if line.strip()]
+        return b"[" + b",".join(lines) + b"]"
     except Exception as e:
         logging.error(f"Error converting JSONL to JSON: {str(e)}")
         raise
@@ -143,9 +177,26 @@ def move_to_finalized(blob_client, finalized_container_client, blob_name, status
         logging.info(f"Moving blob {blob_name} to finalized-batches/{folder_name}...")
         finalized_blob_client = finalized_container_client.get_blob_client(finalized_blob_name)
 
-        # Download content from the source blob and upload to the finalized container
-        blob_content = blob_client.download_blob().readall()
-        finalized_blob_client.upload_blob(blob_content, overwrite=True)
+        # Copy server-side so the blob content never passes through the worker;
+        # same-account copies usually complete immediately, so cap the poll
+        # rather than let one stuck copy hold a pool worker indefinitely
+        copy = finalized_blob_client.start_copy_from_url(blob_client.url)
+        copy_status = finalized_blob_client.get_blob_properties().copy.status
+        for _ in range(COPY_POLL_ATTEMPTS):
+            if copy_status != "pending":
+                break
+            time.sleep(1)
+            copy_status = finalized_blob_client.get_blob_properties().copy.status
+        if copy_status == "pending":
+            logging.error(f"Server-side copy of blob {blob_name} still pending after {COPY_POLL_ATTEMPTS}s; aborting copy.")
+            try:
+                finalized_blob_client.abort_copy(copy["copy_id"])
+            except Exception as abort_error:
+                logging.error(f"Failed to abort copy of blob {blob_name}: {str(abort_error)}")
+            return
+        if copy_status != "success":
+            logging.error(f"Server-side copy of blob {blob_name} finished with status: {copy_status}")
+            return
 
         # Delete the source blob
         blob_client.delete_blob()
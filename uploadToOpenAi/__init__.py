@@ -1,12 +1,107 @@
+import asyncio
 import logging
 import os
+from datetime import datetime
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ServiceRequestError
+from azure.identity import DefaultAzureCredential
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
 from openai import AzureOpenAI
-import json
-import time
-import io
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+import openai
+import orjson
 
-def main(myblob):
+# Queue polled by the pollOpenAiFile function; messages carry the OpenAI
+# file id so status checks happen off this worker
+POLL_QUEUE_NAME = "openai-file-poll"
+
+# Blobs below this size are appended to an hourly aggregate and submitted as
+# one batch by flushPendingBatches instead of paying the upload/poll/submit
+# overhead per tiny file
+SMALL_BLOB_THRESHOLD = 1024 * 1024
+PENDING_CONTAINER = "pending-batches"
+
+# Fields the OpenAI batch API requires on every JSONL line; checked locally
+# before paying for the upload
+REQUIRED_FIELDS = ("custom_id", "method", "url")
+ERROR_CONTAINER = "uploadtoopenai-errors"
+
+# Retry only transient failures (rate limits, dropped connections, 5xx);
+# anything else surfaces immediately
+_transient_retry = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+        ServiceRequestError,
+    )),
+    reraise=True,
+)
+
+# Clients initialized on first invocation and reused while the worker stays
+# warm, so TLS handshakes and connection pools are paid once per instance
+_clients = {}
+
+
+def _get_blob_service():
+    # Prefer managed identity when an account URL is configured: MSAL caches
+    # the AAD token for its lifetime, avoiding the per-call connection-string
+    # parse and shared-key signing, and it works on AAD-only accounts
+    account_url = os.getenv("BLOB_ACCOUNT_URL")
+    if account_url:
+        return BlobServiceClient(account_url=account_url, credential=DefaultAzureCredential())
+    return BlobServiceClient.from_connection_string(os.getenv("batchprocessblob_STORAGE"))
+
+
+def _get_clients():
+    if not _clients:
+        # max_retries=0: the SDK's built-in retry rebuilds the multipart
+        # body from the same file object, and _ChunkedBlobFile cannot be
+        # rewound — a retried request would upload a truncated file.
+        # _transient_retry owns retries and re-opens the download instead.
+        _clients["oai"] = AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version="2024-10-21",
+            max_retries=0
+        )
+        _clients["blob"] = _get_blob_service()
+        _clients["queue"] = QueueClient.from_connection_string(
+            os.getenv("batchprocessblob_STORAGE"), POLL_QUEUE_NAME,
+            message_encode_policy=TextBase64EncodePolicy()
+        )
+    return _clients
+
+
+class _ChunkedBlobFile:
+    """
+    File-like wrapper over a blob downloader that pulls chunks on demand, so
+    the OpenAI uploader streams the blob instead of holding it in memory.
+    """
+
+    def __init__(self, downloader, name):
+        self._chunks = downloader.chunks()
+        self._buffer = b""
+        self.name = name
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + b"".join(self._chunks)
+            self._buffer = b""
+            return data
+        while len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+async def main(myblob):
     """
     Blob Trigger to upload JSONL file to Azure OpenAI for batch processing and save the response.
     """
@@ -20,70 +115,205 @@ def main(myblob):
             logging.warning(f"Skipping blob '{blob_name}' as it is not a .jsonl file.")
             return
 
-        # Read the blob content
-        blob_content = myblob.read()
-        decoded_blob_content = blob_content.decode("utf-8")  # Decoding the content
-        logging.info(f"Read content from blob '{blob_name}'.")
+        clients = _get_clients()
+        client = clients["oai"]
+        blob_service_client = clients["blob"]
 
-        # Initialize OpenAI client
-        client = AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version="2024-10-21"
-        )
+        container_name, _, source_blob_name = blob_name.partition("/")
+        source_blob_client = blob_service_client.get_blob_client(container=container_name, blob=source_blob_name)
 
-        # Step 1: Parse and prepare the JSONL content
-        lines = [json.loads(line) for line in decoded_blob_content.strip().split('\n')]
+        # Coalesce small blobs into the current hourly aggregate; the
+        # flushPendingBatches timer submits the aggregate as a single batch
+        blob_size = myblob.length or 0
+        if 0 < blob_size < SMALL_BLOB_THRESHOLD:
+            # An aggregate stamp means a previous delivery already appended
+            # this blob; appending again would duplicate its custom_ids in
+            # the submitted batch
+            properties = await asyncio.to_thread(source_blob_client.get_blob_properties)
+            existing_aggregate = (properties.metadata or {}).get("pending_aggregate")
+            if existing_aggregate:
+                logging.info(f"Blob '{blob_name}' already appended to aggregate '{existing_aggregate}'; skipping re-delivery.")
+                return
+            content = myblob.read()
+            validation_error = _validate_lines(iter(content.split(b"\n")))
+            if validation_error:
+                logging.error(f"Blob '{blob_name}' failed validation: {validation_error}")
+                await asyncio.to_thread(_save_validation_error, blob_service_client, os.path.basename(blob_name), validation_error)
+                return
+            aggregate_name = await asyncio.to_thread(_append_to_pending, blob_service_client, content)
+            # Stamp the source blob so the re-fired trigger (and any queue
+            # re-delivery) sees the append already happened
+            await asyncio.to_thread(source_blob_client.set_blob_metadata, {"pending_aggregate": aggregate_name})
+            logging.info(f"Blob '{blob_name}' ({blob_size} bytes) appended to aggregate '{aggregate_name}'.")
+            return
 
-        # Prepare the file for upload
-        updated_jsonl_content = "\n".join(json.dumps(line) for line in lines)
-        jsonl_file = io.BytesIO(updated_jsonl_content.encode("utf-8"))  # Encoding for upload
-        jsonl_file.name = os.path.basename(blob_name)
+        # Steps 1-2: Stream the source blob to Azure OpenAI
 
+        # Blob events are delivered at least once; if a batch response for
+        # this file already exists, a re-delivery must not re-upload it and
+        # burn quota on a duplicate batch
+        response_blob_name = f"{os.path.basename(blob_name).removesuffix('.jsonl')}-response.json"
+        response_blob_client = blob_service_client.get_blob_client(container="uploadtoopenai-response", blob=response_blob_name)
+        if await asyncio.to_thread(response_blob_client.exists):
+            logging.info(f"Blob '{blob_name}' already processed; skipping re-delivery.")
+            return
+
+        # A file id stamped on the source blob means a previous invocation
+        # already uploaded it (the metadata write itself re-fires the
+        # trigger); resume at the polling stage instead of re-uploading
+        properties = await asyncio.to_thread(source_blob_client.get_blob_properties)
+        existing_file_id = (properties.metadata or {}).get("openai_file_id")
+        if existing_file_id:
+            logging.info(f"Blob '{blob_name}' already uploaded as file {existing_file_id}; re-enqueuing status check.")
+            await asyncio.to_thread(_enqueue_poll_message, clients["queue"], existing_file_id, os.path.basename(blob_name))
+            return
+
+        # Reject malformed files locally in milliseconds instead of paying
+        # for the upload and waiting for a server-side failure
+        validation_error = await asyncio.to_thread(_validate_blob, source_blob_client)
+        if validation_error:
+            logging.error(f"Blob '{blob_name}' failed validation: {validation_error}")
+            await asyncio.to_thread(_save_validation_error, blob_service_client, os.path.basename(blob_name), validation_error)
+            return
 
-        # Step 2: Upload the JSONL file to Azure OpenAI
         logging.info("Uploading the JSONL file to Azure OpenAI...")
-        file_response = client.files.create(
-            file=jsonl_file,
-            purpose="batch"
-        )
+        file_response = await asyncio.to_thread(_upload_file_to_openai, client, source_blob_client, os.path.basename(blob_name))
         file_id = file_response.id
         logging.info(f"File uploaded successfully to Azure OpenAI. File ID: {file_id}")
 
-        # Step 3: Poll for file status until 'Processed'
-        logging.info("Polling file status until 'Processed'...")
-        file_status = "pending"
-        while file_status not in ["processed", "failed"]:
-            time.sleep(10)  # Wait for 10 seconds before checking again
-            file_info = client.files.retrieve(file_id)
-            file_status = file_info.status
-            logging.info(f"Current file status: {file_status}")
-
-            if file_status == "failed":
-                logging.error("File processing failed. Exiting.")
-                return
-
-        # Step 4: Submit a batch job
-        logging.info("Submitting the batch job to Azure OpenAI...")
-        batch_response = client.batches.create(
-            input_file_id=file_id,
-            endpoint="/chat/completions",
-            completion_window="24h",
-        )
-        batch_id = batch_response.id
-        logging.info(f"Batch job submitted successfully. Batch ID: {batch_id}")
-
-        # Step 5: Save full batch response to uploadtoopenai-response container
-        logging.info("Saving batch response to uploadtoopenai-response container...")
-        container_name = "uploadtoopenai-response"
-        response_blob_name = f"{os.path.basename(blob_name).replace('.jsonl', '')}-response.json"
-        connection_string = os.getenv("batchprocessblob_STORAGE")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        response_blob_client = blob_service_client.get_blob_client(container=container_name, blob=response_blob_name)
+        # Record the file id on the source blob so a restart after this point
+        # can resume at the polling stage instead of re-uploading
+        await asyncio.to_thread(source_blob_client.set_blob_metadata, {"openai_file_id": file_id})
 
-        response_json = json.dumps(batch_response.model_dump(), indent=4)
-        response_blob_client.upload_blob(response_json, overwrite=True)
-        logging.info(f"Batch response saved successfully: {container_name}/{response_blob_name}")
+        # Step 3: Hand the status polling to the queue-triggered
+        # pollOpenAiFile function so this worker is released immediately
+        # instead of sleeping until the file is processed
+        logging.info("Enqueuing file status check for pollOpenAiFile...")
+        await asyncio.to_thread(_enqueue_poll_message, clients["queue"], file_id, os.path.basename(blob_name))
 
     except Exception as e:
+        # Re-raise so the Functions host retries the blob event instead of
+        # treating a transient failure as done
         logging.error(f"An error occurred while processing blob '{blob_name}': {str(e)}")
+        raise
+
+
+def _enqueue_poll_message(queue_client, file_id, filename):
+    """
+    Sends the status-check message that drives pollOpenAiFile, creating the
+    queue on first use.
+    """
+    try:
+        queue_client.create_queue()
+    except ResourceExistsError:
+        pass
+    poll_message = orjson.dumps({
+        "file_id": file_id,
+        "filename": filename,
+        "attempts": 0
+    }).decode()
+    queue_client.send_message(poll_message, visibility_timeout=5)
+    logging.info(f"Status check for file {file_id} enqueued on '{POLL_QUEUE_NAME}'.")
+
+
+@_transient_retry
+def _upload_file_to_openai(client, source_blob_client, filename):
+    """
+    Streams the source blob to Azure OpenAI, re-opening the chunked download
+    on each retry attempt since the stream cannot be rewound.
+
+    Kept synchronous and dispatched through asyncio.to_thread: httpx's
+    multipart encoder reads the file with plain read() calls, and those
+    chunked range downloads must not block the event loop.
+    """
+    jsonl_file = _ChunkedBlobFile(source_blob_client.download_blob(), filename)
+    return client.files.create(
+        file=jsonl_file,
+        purpose="batch"
+    )
+
+
+def _validate_blob(source_blob_client):
+    """
+    Downloads and validates a blob's JSONL content; sync so the chunked
+    download can run in a worker thread.
+    """
+    return _validate_lines(_iter_chunk_lines(source_blob_client.download_blob()))
+
+
+def _iter_chunk_lines(downloader):
+    """
+    Yields JSONL lines from a blob downloader one chunk at a time, holding at
+    most one chunk plus a partial line in memory.
+    """
+    buffer = b""
+    for chunk in downloader.chunks():
+        buffer += chunk
+        while b"\n" in buffer:
+            line, _, buffer = buffer.partition(b"\n")
+            yield line
+    if buffer:
+        yield buffer
+
+
+def _validate_lines(lines):
+    """
+    Checks that every line parses as JSON and carries the fields the batch
+    API requires. Returns an error message for the first bad line, or None.
+    """
+    line_number = 0
+    for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            return f"Line {line_number} is not valid JSON: {e}"
+        missing = [field for field in REQUIRED_FIELDS if field not in record]
+        if missing:
+            return f"Line {line_number} is missing required fields: {', '.join(missing)}"
+    return None
+
+
+def _save_validation_error(blob_service_client, filename, message):
+    """
+    Records a validation failure in the uploadtoopenai-errors container so bad
+    files are visible without digging through logs.
+    """
+    error_blob_client = blob_service_client.get_blob_client(
+        container=ERROR_CONTAINER, blob=f"{filename.removesuffix('.jsonl')}-error.json"
+    )
+    data = orjson.dumps({"file": filename, "error": message})
+    try:
+        error_blob_client.upload_blob(data, overwrite=True)
+    except ResourceNotFoundError:
+        try:
+            blob_service_client.create_container(ERROR_CONTAINER)
+        except ResourceExistsError:
+            pass
+        error_blob_client.upload_blob(data, overwrite=True)
+
+
+def _append_to_pending(blob_service_client, content):
+    """
+    Appends a small JSONL payload to the current hourly aggregate blob,
+    creating the append blob (and container) on first use.
+    """
+    aggregate_name = f"{datetime.utcnow():%Y%m%d%H}.jsonl"
+    aggregate_client = blob_service_client.get_blob_client(container=PENDING_CONTAINER, blob=aggregate_name)
+    if not content.endswith(b"\n"):
+        content += b"\n"
+    try:
+        aggregate_client.append_block(content)
+    except ResourceNotFoundError:
+        try:
+            blob_service_client.create_container(PENDING_CONTAINER)
+        except ResourceExistsError:
+            pass
+        try:
+            aggregate_client.create_append_blob()
+        except ResourceExistsError:
+            pass
+        aggregate_client.append_block(content)
+    return aggregate_name